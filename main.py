@@ -1,103 +1,238 @@
-import json
-from typing import List, Dict, Union, Callable, Optional
+import copy
+import csv
+import functools
+import mmap
+import operator
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, FrozenSet, Iterator, Tuple, Union, Callable
+
+# Use orjson to parse the JSON file when it is installed, otherwise the built-in json module.
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+# Use pyarrow to extract data from large files when it is installed.
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+# Input files of at least this size in bytes are extracted with pyarrow.
+_ARROW_MIN_SIZE = 8 << 20
+
+# Quotes left inside a quoted field by preprocessing an apostrophe: a quote with no delimiter or other quote next to
+# it, or a doubled quote at the end or the start of a field, from a trailing or a leading apostrophe.
+_STRAY_QUOTE = re.compile(
+    rb'"(?<=[^,"\n]")(?=[^,"\r\n])'
+    rb'|"(?<=[^,"\n]")"(?=[,\r\n]|\Z)'
+    rb'|"(?<![^,\n]")"(?=[^,"\r\n])'
+)
+
+# Translation table replacing all other type of quotes with double quotes, used when preprocessing the files.
+_QUOTE_TRANS = str.maketrans({
+    "'": '"',
+    '”': '"',
+    '\u201C': '"',
+    '\u201E': '"',
+    '\u201D': '"',
+    '\u0022': '"'
+})
+
+# The encoded characters that the translation table actually changes.
+_QUOTE_BYTES = tuple(chr(char).encode('utf-8') for char, quote in _QUOTE_TRANS.items() if chr(char) != quote)
+
+
+def _unquote(field: str) -> str:
+    """
+    Removes the double quotes around a field, so column names can be given with or without them.
 
+    :param field: (str) The field, as it is written in a CSV file.
+    :return: (str) The field value.
+    """
 
-class SimpleDictReader:
-    def __init__(self, file: str, fieldnames: List[str], delimiter: str = ',', quotechar: str = '"') -> None:
-        """
-        Initializes a SimpleDictReader instance.
+    if len(field) >= 2 and field[0] == field[-1] == '"':
+        return field[1:-1].replace('""', '"')
+    return field
 
-        :param file: (str) The file-like object to read from.
-        :param fieldnames: (List[str]) List of field names for the CSV header.
-        :param delimiter: (str) The character used to separate fields (default is ',').
-        :param quotechar: (str) The character used for quoting fields (default is '"').
-        :return: None
-        """
-        self.file = file
-        self.fieldnames = fieldnames
-        self.delimiter = delimiter
-        self.quotechar = quotechar
 
-    def _parse_row(self, row: str) -> Dict[str, str]:
-        """
-        Parses a row from the CSV file into a dictionary.
+def _parse_line(line: str) -> Tuple[List[str], Union[str, None]]:
+    """
+    Parses a single CSV line. A line that is not valid CSV, like a quoted field holding a quote that preprocessing
+    turned from an apostrophe, is split on the delimiter instead, and its fields are written as they are.
 
-        :param row: (str) The string representing a row of data.
-        :return: Dict[str, str] A dictionary representing the parsed row.
-        """
+    :param line: (str) The decoded line of data.
+    :return: Tuple[List[str], Union[str, None]] The field values, and for an invalid line the formatted line to write,
+             otherwise None.
+    """
 
-        # Split the row based on the delimiter
-        row = row.rstrip('\n')
-        values = row.split(self.delimiter)
+    try:
+        return next(csv.reader([line], strict=True), ['']), None
+    except csv.Error:
+        fields = line.rstrip('\r\n').split(',')
 
-        # Create a dictionary by pairing fieldnames with corresponding values
-        return dict(zip(self.fieldnames, values))
+        # Format each value, adding quotes only if it has none already.
+        formatted_line = ','.join(field if '"' in field else f'"{field}"' for field in fields) + '\n'
+        return [_unquote(field) for field in fields], formatted_line
 
-    def __iter__(self) -> 'SimpleDictReader':
-        return self
 
-    def __next__(self) -> Optional[Dict[str, str]]:
-        """
-       Reads the next row from the CSV file and returns it as a dictionary.
+def _parsed_field(line: bytes, delimiter: bytes, index: int) -> bytes:
+    """
+    Returns a single field of a line parsed with the csv module, for lines with delimiters inside quoted fields.
+    A line that is not valid CSV, like one holding a quote that preprocessing turned from an apostrophe, is split on
+    the delimiter instead, the same way _parse_line does.
+
+    :param line: (bytes) The raw, undecoded line of data.
+    :param delimiter: (bytes) The character used to separate fields.
+    :param index: (int) The zero based position of the field.
+    :return: (bytes) The field value with double quotes around it, the raw field for an invalid line, or an empty
+             value if the line has fewer fields.
+    """
 
-       :return: Optional[Dict[str, str]]: A dictionary representing the next row of data, or None if the end of the
-                file is reached.
-       """
+    try:
+        row = next(csv.reader([line.decode('utf-8')], delimiter=delimiter.decode('utf-8'), strict=True), [])
+    except csv.Error:
+        fields = line.rstrip(b'\r\n').split(delimiter)
+        return fields[index] if index < len(fields) else b''
 
-        # Read a line from the file
-        line = next(self.file, None)
+    if index >= len(row):
+        return b''
+    return b'"' + row[index].encode('utf-8').replace(b'"', b'""') + b'"'
 
-        # If the line is None, we've reached the end of the file
-        if line is None:
-            raise StopIteration
 
-        # Parse the line into a dictionary
-        row_dict = self._parse_row(line)
+def _nth_field(line: bytes, delimiter: bytes, index: int) -> bytes:
+    """
+    Returns a single field of a delimited line, scanning for the delimiters instead of splitting the whole line.
+    A field with an odd number of quotes means a delimiter is inside quotes, so the line is parsed in full instead.
 
-        return row_dict
+    :param line: (bytes) The raw, undecoded line of data.
+    :param delimiter: (bytes) The character used to separate fields.
+    :param index: (int) The zero based position of the field.
+    :return: (bytes) The field value, or an empty value if the line has fewer fields.
+    """
 
+    # Skip the fields before the one requested.
+    start = 0
+    for _ in range(index):
+        end = line.find(delimiter, start)
+        if end == -1:
+            return b''
+        if line.count(b'"', start, end) % 2:
+            return _parsed_field(line, delimiter, index)
+        start = end + 1
+
+    # The last field of the line runs up to the line terminator.
+    end = line.find(delimiter, start)
+    field = line[start:].rstrip(b'\r\n') if end == -1 else line[start:end]
+    if field.count(b'"') % 2:
+        return _parsed_field(line, delimiter, index)
+    return field
+
+
+def _iter_lines(buffer: mmap.mmap, start: int = 0, block_size: int = 1 << 20) -> Iterator[bytes]:
+    """
+    Yields the lines of a memory mapped file. The file is split in blocks of whole lines, so the line ends of a
+    block are all located in a single pass.
 
-class SimpleDictWriter:
-    def __init__(self, file: str, fieldnames: List[str], delimiter: str = ',', quotechar: str = '"') -> None:
-        """
-        Initializes a SimpleDictWriter instance.
+    :param buffer: (mmap.mmap) The memory mapped file.
+    :param start: (int) The offset of the first line to yield.
+    :param block_size: (int) The approximate size in bytes of the blocks.
+    :return: Iterator[bytes] The lines of the file, without their newline characters.
+    """
 
-        :param file : (str) The file-like object to write to.
-        :param fieldnames : (List[str]) List of field names for the CSV header.
-        :param delimiter : (str) The character used to separate fields (default is ',').
-        :param quotechar : (str) The character used for quoting fields (default is '"').
-        :return: None
+    size = len(buffer)
+    while start < size:
 
-        """
-        self.file = file
-        self.fieldnames = fieldnames
-        self.delimiter = delimiter
-        self.quotechar = quotechar
+        # Extend the block up to the end of the line it stops in.
+        end = buffer.find(b'\n', start + block_size) + 1 or size
 
-    def _format_row(self, row: dict) -> str:
-        """
-        Formats a row for writing to the CSV file.
+        lines = buffer[start:end].split(b'\n')
 
-        :param row : (dict) The dictionary representing a row of data.
-        :return: (str) The formatted row as a string.
-        """
-        # Format each value, adding quotes if needed
-        formatted_values = [f'{self.quotechar}{row[field]}{self.quotechar}' if '"' not in row[field] else f'{row[field]}' for field in self.fieldnames]
+        # A block ending with a line terminator leaves an empty piece behind.
+        if not lines[-1]:
+            lines.pop()
+        yield from lines
+        start = end
 
-        # Join the formatted values with the delimiter
-        return self.delimiter.join(formatted_values)
 
-    def writerow(self, row: dict) -> None:
-        """
-        Writes a row to the CSV file.
+def _needs_preprocessing(file: str) -> bool:
+    """
+    Checks whether a file contains any of the quotes that preprocessing replaces, without decoding it.
+
+    :param file: (str) The file path to check.
+    :return: (bool) True if the file has to be preprocessed.
+    """
+
+    # An empty file cannot be memory mapped, and has nothing to replace anyway.
+    if not os.path.getsize(file):
+        return False
+
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        return any(buffer.find(char) != -1 for char in _QUOTE_BYTES)
 
-        :param row : (dict) The dictionary representing a row of data.
-        :return: None
-        """
 
-        # Format the row and write it to the file
-        formatted_row = self._format_row(row)
-        self.file.write(formatted_row + '\n')
+def _has_stray_quotes(file: str) -> bool:
+    """
+    Checks whether a file has quotes inside quoted fields that are not escaped, without decoding it.
+
+    :param file: (str) The file path to check.
+    :return: (bool) True if the file has any stray quotes.
+    """
+
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        return _STRAY_QUOTE.search(buffer) is not None
+
+
+@functools.lru_cache(maxsize=None)
+def _load_codes(file: str, key_column: str, mtime_ns: int) -> FrozenSet[str]:
+    """
+    Reads the codes of a column from a CSV file. The result is cached, so a sample file shared by several extractors
+    is only parsed once, until the file is modified.
+
+    :param file: (str) The CSV file path.
+    :param key_column: (str) The column containing the codes.
+    :param mtime_ns: (int) The modification time of the file, part of the cache key only.
+    :return: FrozenSet[str] A set of the codes.
+    """
+
+    with open(file, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        key_idx = next(reader).index(_unquote(key_column))
+        return frozenset(row[key_idx] for row in reader if row)
+
+
+def _preprocess_file(file: str) -> None:
+    """
+    Preprocesses a single file by replacing various quote characters with double quotes. It is a module level function
+    so it can run in a worker process.
+
+    :param file: (str) The file path to be processed.
+    :return: None
+    """
+
+    # Files already using only double quotes are left untouched.
+    if not _needs_preprocessing(file):
+        return
+
+    # Stream the modified lines into a temporary file next to the original, one line at a time.
+    tmp = tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(os.path.abspath(file)), delete=False)
+    try:
+        with open(file, 'r', encoding='utf-8') as f, tmp:
+            for line in f:
+                tmp.write(line.translate(_QUOTE_TRANS))
+
+        # Replace the original file, keeping its permissions.
+        shutil.copymode(file, tmp.name)
+        os.replace(tmp.name, file)
+    except Exception:
+        os.remove(tmp.name)
+        raise
 
 
 class DataExtractor:
@@ -128,28 +263,24 @@ class DataExtractor:
         self.codes = self.read_codes(key_column)
         self.relevant_keys = {}
 
-    def read_codes(self, key_column: str, file: Union[str, None] = None) -> List[str]:
+    def read_codes(self, key_column: str, file: Union[str, None] = None) -> FrozenSet[str]:
         """
         Reads customer codes from the specified CSV file or the default sample file.
 
         :param key_column : (str) The column containing the customer codes.
         :param file : (Union[str, None]) The CSV file path. If None, uses the default sample file.
 
-        :return: List[str] A list of customer codes.
+        :return: FrozenSet[str] A set of customer codes, for constant time membership checks.
         """
 
         if file is None:
             file = self.sample_file
 
-        with open(self.sample_file, 'r', encoding='utf-8') as file:
-            header = file.readline().strip().split(',')
-            reader = SimpleDictReader(file, header)
-            customers = [row[key_column] for row in reader]
-            return customers
+        return _load_codes(file, key_column, os.stat(file).st_mtime_ns)
 
     def extract_data(
             self, input_file: str, output_file: str, key_column: str, record_relevant_keys: Union[list, None] = None
-    ) -> Union[Dict[str, List[str]], None]:
+    ) -> Union[Dict[str, FrozenSet[str]], None]:
         """
         Extracts data from the input file based on the specified key column and writes it to the output file.
 
@@ -159,44 +290,139 @@ class DataExtractor:
         :param record_relevant_keys : (Union[List[str], None]) List of keys to record in relevant_keys. If None, no recording.
 
         Returns:
-            Union[Dict[str, List[str]], None]: A dictionary containing relevant keys and their values, or None if no relevant keys were recorded.
+            Union[Dict[str, FrozenSet[str]], None]: A dictionary containing relevant keys, without quotes, and their unique values, or None if no relevant keys were recorded.
         """
 
+        # An empty file cannot be memory mapped, and has no rows to extract.
+        input_size = os.path.getsize(input_file)
+        if not input_size:
+            open(output_file, 'w', encoding='utf-8').close()
+            self._columns_to_record([], record_relevant_keys)
+            return self._recorded_keys()
+
+        # Large files are read, filtered and written by pyarrow in multiple threads when it is installed. Files with
+        # stray quotes are left to the csv module, which writes those lines as they are.
+        if pa is not None and input_size >= _ARROW_MIN_SIZE and not _has_stray_quotes(input_file):
+            try:
+                self._extract_data_arrow(input_file, output_file, key_column, record_relevant_keys)
+                return self._recorded_keys()
+            except pa.ArrowInvalid:
+                # Files that pyarrow cannot parse are extracted with the csv module instead.
+                pass
+
+        # The keys are matched on the raw bytes, quoted or not, so only the matching lines need to be decoded.
+        codes = set()
+        for code in self.codes:
+            code = code.encode('utf-8')
+            codes.add(code)
+            codes.add(b'"' + code.replace(b'"', b'""') + b'"')
+
         # Processing both reading and writing operations at the same time.
-        with open(input_file, 'r', newline='', encoding='utf-8') as infile, \
-             open(output_file, 'w', newline='', encoding='utf-8') as outfile:
+        with open(input_file, 'rb') as infile, \
+             mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as inbuffer, \
+             open(output_file, 'w', newline='', encoding='utf-8', buffering=1 << 20) as outfile:
 
             # Get headers
-            header = infile.readline().strip().split(',')
+            header_end = inbuffer.find(b'\n') + 1 or len(inbuffer)
+            header = next(csv.reader([inbuffer[:header_end].decode('utf-8')]))
+
+            # Resolve the column positions once, rows are then indexed by position.
+            key_idx = header.index(_unquote(key_column))
+
+            # Only the lines with a matching key are fully parsed, blank lines are skipped, as an empty code would
+            # match them. The helper is bound to a local name, as it is looked up for every line.
+            nth_field = _nth_field
+            matching_lines = (
+                line.decode('utf-8') for line in _iter_lines(inbuffer, header_end)
+                if line and line != b'\r' and nth_field(line, b',', key_idx) in codes
+            )
+
+            # Writer Object, every value is written with double quotes.
+            writer = csv.writer(outfile, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            writer.writerow(header)
+
+            # Write the matching rows, keeping them in memory only when there are relevant keys to record.
+            matched_rows = []
+            for line in matching_lines:
+                row, invalid_line = _parse_line(line)
+                if invalid_line is None:
+                    writer.writerow(row)
+                else:
+                    outfile.write(invalid_line)
+                if record_relevant_keys:
+                    matched_rows.append(row)
 
-            # Reader object
-            reader = SimpleDictReader(infile, header)
+            # Record any relevant keys, column by column over the matched rows. Values recorded by previous
+            # extractions are kept.
+            for key, idx in self._columns_to_record(header, record_relevant_keys):
+                self.relevant_keys[key].update(map(operator.itemgetter(idx), matched_rows))
 
-            # Writer Object
-            writer = SimpleDictWriter(outfile, header)
+        return self._recorded_keys()
 
-            # Manually format the header with double quotes
-            writer.writerow({key: key for key in writer.fieldnames})
+    def _extract_data_arrow(
+            self, input_file: str, output_file: str, key_column: str, record_relevant_keys: Union[list, None] = None
+    ) -> None:
+        """
+        Extracts data like extract_data, using pyarrow to read, filter and write the files.
 
-            # Initialize key value pairs for relevant_keys
-            if record_relevant_keys:
-                self.relevant_keys = {key: [] for key in record_relevant_keys}
+        :param input_file : (str) The path to the input CSV file.
+        :param output_file : (str) The path to the output CSV file.
+        :param key_column : (str) The column used as the key for extraction.
+        :param record_relevant_keys : (Union[List[str], None]) List of keys to record in relevant_keys. If None, no recording.
+        :return: None
+        """
 
-            for row in reader:
+        # Get headers, so every column is read as text.
+        with open(input_file, 'r', newline='', encoding='utf-8') as infile:
+            header = next(csv.reader(infile))
+        key_idx = header.index(_unquote(key_column))
 
-                code = row[key_column]
+        table = pa_csv.read_csv(
+            input_file,
+            read_options=pa_csv.ReadOptions(block_size=8 << 20, use_threads=True),
+            convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in header})
+        )
 
-                # Matching the keys of interest.
-                if code in self.codes:
+        # Keep only the rows matching the keys of interest.
+        mask = pc.is_in(table.column(key_idx), value_set=pa.array(list(self.codes), type=pa.string()))
+        matched = table.filter(mask)
 
-                    # Record any relevant keys.
-                    if record_relevant_keys:
-                        for key in record_relevant_keys:
-                            if key in row.keys():
-                                self.relevant_keys[key].append(row[key])
-                    writer.writerow(row)
+        # Every value is written with double quotes.
+        pa_csv.write_csv(matched, output_file, write_options=pa_csv.WriteOptions(quoting_style='all_valid'))
+
+        # Record any relevant keys. Values recorded by previous extractions are kept.
+        for key, idx in self._columns_to_record(header, record_relevant_keys):
+            self.relevant_keys[key].update(matched.column(idx).to_pylist())
+
+    def _columns_to_record(self, header: List[str], record_relevant_keys: Union[list, None]) -> List[Tuple[str, int]]:
+        """
+        Prepares relevant_keys for the keys to record, and finds their columns in the header.
+
+        :param header: (List[str]) The header of the input file.
+        :param record_relevant_keys : (Union[List[str], None]) List of keys to record in relevant_keys.
+        :return: List[Tuple[str, int]] The keys found in the header, with their column positions.
+        """
+
+        if not record_relevant_keys:
+            return []
 
-            return self.relevant_keys if self.relevant_keys else None
+        # The keys are stored without quotes, the same way they are looked up.
+        keys = [_unquote(key) for key in record_relevant_keys]
+        for key in keys:
+            self.relevant_keys.setdefault(key, set())
+        return [(key, header.index(key)) for key in keys if key in header]
+
+    def _recorded_keys(self) -> Union[Dict[str, FrozenSet[str]], None]:
+        """
+        Returns the recorded relevant keys as sets, ready to be used as the codes of interest of a following extraction.
+
+        :return: Union[Dict[str, FrozenSet[str]], None] The relevant keys and their unique values, or None if no
+                 relevant keys were recorded.
+        """
+
+        if not self.relevant_keys:
+            return None
+        return {key: frozenset(values) for key, values in self.relevant_keys.items()}
 
     @staticmethod
     def preprocess_data(files: List[str]) -> None:
@@ -208,30 +434,26 @@ class DataExtractor:
         :return: None
         """
 
-        for file in files:
-            with open(file, 'r+', encoding='utf-8') as f:
-                # Read all lines into a list
-                lines = f.readlines()
+        # The files are independent of each other, so several of them are preprocessed in parallel. A file listed more
+        # than once is only preprocessed once, so no two workers rewrite it at the same time.
+        files = list(dict.fromkeys(files))
+        if len(files) > 1:
+            with ProcessPoolExecutor() as executor:
+                list(executor.map(_preprocess_file, files))
+        elif files:
+            _preprocess_file(files[0])
 
-                # Replace all other type of quotes with double quotes for each line.
 
-                quote_mapping = {
-                    "'": '"',
-                    '”': '"',
-                    '\u201C': '"',
-                    '\u201E': '"',
-                    '\u201D': '"',
-                    '\u0022': '"'
-                }
-
-                modified_lines = [line.translate(str.maketrans(quote_mapping)) for line in lines]
+def _run_extraction(data_extractor: DataExtractor, extraction: dict) -> None:
+    """
+    Runs an extraction that records no relevant keys. It is a module level function so it can run in a worker process.
 
-                # Move the file cursor to the beginning and truncate the file
-                f.seek(0)
-                f.truncate()
+    :param data_extractor: (DataExtractor) The extractor holding the codes of interest for this extraction.
+    :param extraction: (dict) The extraction information, as read from the JSON file.
+    :return: None
+    """
 
-                # Write to the file
-                f.writelines(modified_lines)
+    data_extractor.extract_data(extraction['input'], extraction['output'], extraction['key_column'])
 
 
 def process_extraction_info(file: str) -> None:
@@ -243,8 +465,8 @@ def process_extraction_info(file: str) -> None:
         """
 
     # Read extraction information from the JSON file.
-    with open(file, 'r') as json_file:
-        data = json.load(json_file)
+    with open(file, 'rb') as json_file:
+        data = _json_loads(json_file.read())
         extraction_info = data.get("extraction_info")
         infiles = [i.get('input') for i in extraction_info]
         sample_file, main_key_column = data.get("main").values()
@@ -252,14 +474,41 @@ def process_extraction_info(file: str) -> None:
     # Initialize DataExtractor with the customer sample file
     data_extractor = DataExtractor(sample_file, main_key_column, preprocess_files=True, files=infiles)
 
-    # Execute the extraction process according to the provided sequence.
+    # Execute the extraction process according to the provided sequence. The extractions recording relevant keys
+    # affect the following ones, so they run in order while the rest run in parallel worker processes.
     codes = None
-    for extraction in extraction_info:
-        if codes:
-            data_extractor.codes = codes.get(extraction['key_column'])
-        codes = data_extractor.extract_data(
-            extraction['input'], extraction['output'], extraction['key_column'], extraction.get('relevant_keys')
-        )
+    with ProcessPoolExecutor() as executor:
+        pending = {}
+        for extraction in extraction_info:
+
+            # Wait for the parallel extractions sharing a file with this one, other than a common input, as they
+            # would have finished first when run in order.
+            input_file, output_file = os.path.realpath(extraction['input']), os.path.realpath(extraction['output'])
+            for future, (future_input, future_output) in list(pending.items()):
+                if future_output in (input_file, output_file) or future_input == output_file:
+                    future.result()
+                    del pending[future]
+
+            if codes:
+                # Check the codes here, so a missing key column fails before any extraction is handed over.
+                key_codes = codes.get(_unquote(extraction['key_column']))
+                if key_codes is None:
+                    raise ValueError(f"No relevant keys were recorded for the key column {extraction['key_column']}.")
+                data_extractor.codes = key_codes
+
+            if extraction.get('relevant_keys'):
+                codes = data_extractor.extract_data(
+                    extraction['input'], extraction['output'], extraction['key_column'], extraction['relevant_keys']
+                )
+            else:
+                # Hand over a copy, so the worker gets the codes of interest as they are now.
+                snapshot = copy.copy(data_extractor)
+                snapshot.relevant_keys = {}
+                pending[executor.submit(_run_extraction, snapshot, extraction)] = (input_file, output_file)
+
+        # Raise any error of the parallel extractions.
+        for future in pending:
+            future.result()
 
 
 if __name__ == "__main__":